@@ -1,13 +1,19 @@
 import sys
 import configparser
+import functools
+from types import MappingProxyType
 import psycopg2
 
+@functools.lru_cache(maxsize=4)
 def load_config(path='config.ini'):
 	cfg = configparser.ConfigParser()
 	if not cfg.read(path):
 		print(f"Cannot read config file: {path}", file=sys.stderr)
 		sys.exit(1)
-	return cfg
+	return MappingProxyType({
+		section: MappingProxyType(dict(cfg[section]))
+		for section in cfg.sections()
+	})
 
 def distribute():
 	cfg = load_config()
@@ -18,87 +24,103 @@ def distribute():
 	)
 	cur = conn.cursor()
 
+	# psycopg2 opens the transaction implicitly; everything below commits once.
+	cur.execute(
+		"""
+		SET LOCAL synchronous_commit = off;
+		SET LOCAL work_mem = '512MB';
+		SET LOCAL max_parallel_workers_per_gather = 8;
+		"""
+	)
 	cur.execute("DROP TABLE IF EXISTS shipments;")
 	cur.execute(
 		"""
-		CREATE TABLE shipments (
+		CREATE UNLOGGED TABLE shipments (
 			branch_id    UUID NOT NULL,
 			product_id   UUID NOT NULL,
 			shipment_qty INT  NOT NULL
 		);
 		"""
 	)
-	conn.commit()
+
+	cur.execute(
+		"""
+		CREATE INDEX IF NOT EXISTS ix_bp_branch
+			ON branch_products (branch_id) INCLUDE (stock, transit, reserve);
+		CREATE INDEX IF NOT EXISTS ix_rc_product
+			ON rc_products (product_id) INCLUDE (stock);
+		ANALYZE branch_products, needs, stores, rc_products;
+		"""
+	)
 
 	distribution_sql = """
+	CREATE TEMP TABLE first_pass ON COMMIT DROP AS
 	WITH
-	available AS (
-		SELECT bp.product_id, bp.branch_id,
-			GREATEST(0, n.need - (bp.stock + bp.transit - bp.reserve)) AS deficit,
-			s.priority
-		FROM branch_products bp
-		JOIN needs n ON bp.branch_id = n.branch_id AND bp.product_id = n.product_id
-		JOIN stores s ON bp.branch_id = s.branch_id
-	),
-	rc AS (
-		SELECT product_id, SUM(stock)::BIGINT AS total_stock
-		FROM rc_products GROUP BY product_id
-	),
-	sum_weights AS (
-		SELECT product_id, SUM(deficit * priority) AS total_weight
-		FROM available GROUP BY product_id
-	),
 	first_alloc AS (
 		SELECT a.product_id, a.branch_id, a.deficit, a.priority,
-			rc.total_stock, sw.total_weight
-		FROM available a
-		JOIN rc ON rc.product_id = a.product_id
-		JOIN sum_weights sw ON sw.product_id = a.product_id
-	),
-	first_pass AS (
-		SELECT
-		product_id,
-		branch_id,
-		deficit,
+			rc.total_stock,
+			SUM(a.deficit * a.priority) OVER (PARTITION BY a.product_id) AS total_weight
+		FROM (
+			SELECT bp.product_id, bp.branch_id,
+				GREATEST(0, n.need - (bp.stock + bp.transit - bp.reserve)) AS deficit,
+				s.priority
+			FROM branch_products bp
+			JOIN needs n ON bp.branch_id = n.branch_id AND bp.product_id = n.product_id
+			JOIN stores s ON bp.branch_id = s.branch_id
+		) a
+		JOIN (
+			SELECT product_id, SUM(stock)::BIGINT AS total_stock
+			FROM rc_products GROUP BY product_id
+		) rc ON rc.product_id = a.product_id
+	)
+	SELECT
+	product_id,
+	branch_id,
+	deficit,
+	priority,
+	total_stock,
+	LEAST(
+		COALESCE(
+		FLOOR(
+			total_stock * (deficit * priority)::numeric
+			/ NULLIF(total_weight, 0)
+		)::int,
+		0
+		),
+		deficit
+	) AS shipped
+	FROM first_alloc;
+
+	ANALYZE first_pass;
+
+	CREATE TEMP TABLE pass1 ON COMMIT DROP AS
+	SELECT product_id, branch_id,
+		deficit - shipped AS deficit,
 		priority,
-		LEAST(
-			COALESCE(
-			FLOOR(
-				total_stock * (deficit * priority)::numeric
-				/ NULLIF(total_weight, 0)
-			)::int,
-			0
-			),
-			deficit
-		) AS shipped
-		FROM first_alloc
-	),
-	remaining AS (
-		SELECT fp.product_id,
-			rc.total_stock - SUM(fp.shipped) AS remaining
-		FROM first_pass fp
-		JOIN rc ON rc.product_id = fp.product_id
-		GROUP BY fp.product_id, rc.total_stock
-	),
-	pass1 AS (
-		SELECT fp.product_id, fp.branch_id,
-			fp.deficit - fp.shipped AS deficit,
-			fp.priority,
-			fp.shipped,
-			rem.remaining
-		FROM first_pass fp
-		JOIN remaining rem ON rem.product_id = fp.product_id
+		shipped,
+		total_stock - SUM(shipped) OVER (PARTITION BY product_id) AS remaining
+	FROM first_pass;
+
+	CREATE INDEX ON pass1 (product_id, priority DESC);
+	ANALYZE pass1;
+
+	WITH
+	top_up AS (
+		SELECT t.product_id, t.branch_id
+		FROM (SELECT DISTINCT product_id, remaining FROM pass1) r
+		CROSS JOIN LATERAL (
+			SELECT product_id, branch_id
+			FROM pass1
+			WHERE product_id = r.product_id
+			ORDER BY priority DESC
+			LIMIT GREATEST(FLOOR(r.remaining), 0)::bigint
+		) t
 	),
 	second_pass AS (
-		SELECT
-		branch_id,
-		product_id,
-		shipped +
-		CASE WHEN ROW_NUMBER() OVER (
-			PARTITION BY product_id ORDER BY priority DESC
-			) <= remaining THEN 1 ELSE 0 END
-		AS shipment_qty
-		FROM pass1
+		SELECT p.branch_id, p.product_id,
+			p.shipped + CASE WHEN tu.branch_id IS NULL THEN 0 ELSE 1 END AS shipment_qty
+		FROM pass1 p
+		LEFT JOIN top_up tu ON tu.product_id = p.product_id AND tu.branch_id = p.branch_id
 	)
 	INSERT INTO shipments(branch_id, product_id, shipment_qty)
 	SELECT branch_id, product_id, shipment_qty
@@ -107,7 +129,6 @@ def distribute():
 	"""
 
 	cur.execute(distribution_sql)
-	conn.commit()
 
 	adjustment_sql = """
 	WITH
@@ -127,29 +148,26 @@ def distribute():
 		WHERE sh.branch_id = tz.branch_id
 		RETURNING sh.product_id, sh.shipment_qty
 	),
-	leftovers AS (
-		SELECT product_id, SUM(shipment_qty) AS leftover
-		FROM zeroed GROUP BY product_id
-	),
-	avail AS (
-		SELECT bp.branch_id, bp.product_id, s.priority
-		FROM branch_products bp
-		JOIN stores s ON bp.branch_id = s.branch_id
-		JOIN needs n ON bp.branch_id = n.branch_id AND bp.product_id = n.product_id
-		WHERE GREATEST(0, n.need - (bp.stock + bp.transit - bp.reserve)) > 0
-	),
 	alloc AS (
-		SELECT a.branch_id, l.product_id,
-			CASE WHEN ROW_NUMBER() OVER (
-				PARTITION BY l.product_id ORDER BY a.priority DESC
-			) <= l.leftover THEN 1 ELSE 0 END AS add_qty
-		FROM leftovers l
-		JOIN avail a ON a.product_id = l.product_id
+		SELECT a.branch_id, l.product_id, 1 AS add_qty
+		FROM (
+			SELECT product_id, SUM(shipment_qty) AS leftover
+			FROM zeroed GROUP BY product_id
+		) l
+		CROSS JOIN LATERAL (
+			SELECT bp.branch_id
+			FROM branch_products bp
+			JOIN stores s ON bp.branch_id = s.branch_id
+			JOIN needs n ON bp.branch_id = n.branch_id AND bp.product_id = n.product_id
+			WHERE bp.product_id = l.product_id
+				AND GREATEST(0, n.need - (bp.stock + bp.transit - bp.reserve)) > 0
+			ORDER BY s.priority DESC
+			LIMIT l.leftover
+		) a
 	)
 	INSERT INTO shipments(branch_id, product_id, shipment_qty)
 	SELECT branch_id, product_id, add_qty
-	FROM alloc
-	WHERE add_qty > 0;
+	FROM alloc;
 	"""
 	cur.execute(adjustment_sql)
 	conn.commit()
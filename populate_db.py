@@ -1,18 +1,42 @@
 import os
 import sys
 import configparser
-import math
-import random
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from types import MappingProxyType
 import psycopg2
-from psycopg2.extras import execute_values, DictCursor
 from tqdm import tqdm
 
+@functools.lru_cache(maxsize=4)
 def load_config(path='config.ini'):
 	cfg = configparser.ConfigParser()
 	if not cfg.read(path):
 		print(f"Cannot read config file: {path}", file=sys.stderr)
 		sys.exit(1)
-	return cfg
+	return MappingProxyType({
+		section: MappingProxyType(dict(cfg[section]))
+		for section in cfg.sections()
+	})
+
+def connect(db):
+	return psycopg2.connect(
+		dbname=db['name'],
+		user=db['user'],
+		password=db['password'],
+		host=db.get('host', 'localhost'),
+		port=db.get('port', '5432'),
+		options='-c synchronous_commit=off'
+	)
+
+def random_expr(seed, salt, *columns):
+	# with a seed, hash the row key into [0, 1) so the value does not depend on scan order
+	if seed is None:
+		return "random()"
+	expr = str(int(seed) + salt)
+	for c in columns:
+		expr = f"uuid_hash_extended({c}, {expr})"
+	return f"({expr} & 4294967295)::float8 / 4294967296"
 
 def create_tables(cur):
 	cur.execute("""
@@ -63,20 +87,17 @@ def create_tables(cur):
 	""")
 
 def copy_csv(cur, table, csv_path):
-	with open(csv_path, 'r', encoding='cp1251') as f:
-		next(f)  # skip header
-		cur.copy_expert(f"COPY {table} FROM STDIN WITH CSV HEADER", f)
-
-def populate_products(cur, conn, prod_csv):
-	cur.execute("CREATE TEMP TABLE tmp_products (product_id UUID, category_id UUID);")
-	conn.commit()
-	with open(prod_csv, 'r', encoding='cp1251') as f:
-		next(f)
+	# raw bytes in 1 MB reads; the server decodes cp1251 and skips the header
+	with open(csv_path, 'rb', buffering=1 << 20) as f:
 		cur.copy_expert(
-			"COPY tmp_products(product_id, category_id) FROM STDIN WITH CSV HEADER",
-			f
+			f"COPY {table} FROM STDIN WITH (FORMAT CSV, HEADER, ENCODING 'WIN1251')",
+			f,
+			size=1 << 20
 		)
-	conn.commit()
+
+def populate_products(cur, prod_csv):
+	cur.execute("CREATE TEMP TABLE tmp_products (product_id UUID, category_id UUID);")
+	copy_csv(cur, 'tmp_products(product_id, category_id)', prod_csv)
 	cur.execute("""
 	INSERT INTO products(product_id, category_id)
 	SELECT p.product_id, p.category_id
@@ -85,11 +106,9 @@ def populate_products(cur, conn, prod_csv):
 		OR EXISTS(SELECT 1 FROM branch_products bp WHERE bp.product_id = p.product_id)
 	ON CONFLICT DO NOTHING;
 	""")
-	conn.commit()
 	cur.execute("DROP TABLE tmp_products;")
-	conn.commit()
 
-def populate_auxiliary(cur, conn):
+def populate_auxiliary(cur, seed):
 	cur.execute("""
 	INSERT INTO logdays(branch_id, category_id, logdays)
 	SELECT b.branch_id, c.category_id, 7
@@ -97,83 +116,72 @@ def populate_auxiliary(cur, conn):
 	CROSS JOIN (SELECT DISTINCT category_id FROM products) c
 	ON CONFLICT DO NOTHING;
 	""")
-	cur.execute("""
+	cur.execute(f"""
 	INSERT INTO stores(branch_id, priority, min_shipment)
 	SELECT DISTINCT bp.branch_id,
-			(FLOOR(random()*5)+1)::int,
-			(FLOOR(random()*20)+1)::int
+			(FLOOR({random_expr(seed, 1, 'bp.branch_id')}*5)+1)::int,
+			(FLOOR({random_expr(seed, 2, 'bp.branch_id')}*20)+1)::int
 	FROM branch_products bp
 	ON CONFLICT DO NOTHING;
 	""")
-	conn.commit()
-
-def populate_needs(conn):
-	with conn.cursor(cursor_factory=DictCursor) as cur:
-		cur.execute("SELECT product_id, category_id FROM products;")
-		prod2cat = {r['product_id']: r['category_id'] for r in cur}
-		cur.execute("SELECT branch_id, category_id, logdays FROM logdays;")
-		log_map = {(r['branch_id'], r['category_id']): r['logdays'] for r in cur}
-		cur.execute("SELECT branch_id, min_shipment FROM stores;")
-		min_ship_map = {r[0]: r[1] for r in cur.fetchall()}
-
-	read_cur = conn.cursor(name='bp_cur', cursor_factory=DictCursor, withhold=True)
-	read_cur.itersize = 10000
-	read_cur.execute("SELECT branch_id, product_id, stock FROM branch_products;")
-	write_cur = conn.cursor()
-	batch = []
-
-	for row in tqdm(read_cur, desc='Processing needs'):
-		b, p, stock = row['branch_id'], row['product_id'], float(row['stock'])
-		ld = log_map.get((b, prod2cat.get(p)), 7)
-		need_calc = math.floor(random.random() * max(150.0, stock) * ld) + 1
-		need_val = max(need_calc, min_ship_map.get(b, 1))
-		batch.append((b, p, need_val))
-
-		if len(batch) >= 10000:
-			execute_values(
-				write_cur,
-				"INSERT INTO needs(branch_id, product_id, need) VALUES %s ON CONFLICT DO NOTHING",
-				batch
-			)
-			conn.commit()
-			batch.clear()
-
-	if batch:
-		execute_values(
-			write_cur,
-			"INSERT INTO needs(branch_id, product_id, need) VALUES %s ON CONFLICT DO NOTHING",
-			batch
-		)
-		conn.commit()
 
-	read_cur.close()
-	write_cur.close()
+def populate_needs_part(db, part, parts, seed):
+	with closing(connect(db)) as conn:
+		with conn, conn.cursor() as cur:
+			cur.execute(f"""
+			INSERT INTO needs(branch_id, product_id, need)
+			SELECT bp.branch_id, bp.product_id,
+					GREATEST(
+						FLOOR({random_expr(seed, 0, 'bp.branch_id', 'bp.product_id')} * GREATEST(150.0, bp.stock::float8) * COALESCE(l.logdays, 7))::int + 1,
+						COALESCE(s.min_shipment, 1)
+					)
+			FROM branch_products bp
+			LEFT JOIN products p ON p.product_id = bp.product_id
+			LEFT JOIN logdays  l ON l.branch_id = bp.branch_id AND l.category_id = p.category_id
+			LEFT JOIN stores   s ON s.branch_id = bp.branch_id
+			WHERE (hashtext(bp.branch_id::text) & 2147483647) %% %s = %s
+			ON CONFLICT DO NOTHING;
+			""", (parts, part))
+
+def populate_needs(db, workers, seed):
+	# INSERT ... SELECT never gets a parallel plan, so split it across sessions
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		list(pool.map(lambda part: populate_needs_part(db, part, workers, seed), range(workers)))
 
 def main():
 	cfg = load_config()
 	db = cfg['database']
 	files = cfg['csv_files']
+	tuning = cfg.get('tuning', {})
+	workers = int(tuning.get('workers', min(8, os.cpu_count() or 1)))
+	if workers < 1:
+		print(f"[tuning] workers must be at least 1, got {workers}", file=sys.stderr)
+		sys.exit(1)
+	seed = None
+	if 'seed' in tuning:
+		try:
+			seed = int(tuning['seed'])
+		except ValueError:
+			pass
+		if seed is None or not -2**62 <= seed < 2**62:
+			print(f"[tuning] seed must be an integer within +/-2**62, got {tuning['seed']!r}", file=sys.stderr)
+			sys.exit(1)
 	base = os.path.dirname(os.path.abspath(__file__))
 	rc_csv   = os.path.join(base, files['rc_csv'])
 	bp_csv   = os.path.join(base, files['bp_csv'])
 	prod_csv = os.path.join(base, files['prod_csv'])
 
-	conn = psycopg2.connect(
-		dbname=db['name'],
-		user=db['user'],
-		password=db['password'],
-		host=db.get('host', 'localhost'),
-		port=db.get('port', '5432')
-	)
+	conn = connect(db)
 	cur = conn.cursor()
 
 	steps = [
 		('Creating tables',            lambda: create_tables(cur)),
-		('Loading rc_products CSV',    lambda: copy_csv(cur, 'rc_products', rc_csv)   or conn.commit()),
-		('Loading branch_products CSV',lambda: copy_csv(cur, 'branch_products', bp_csv) or conn.commit()),
-		('Populating products table',  lambda: populate_products(cur, conn, prod_csv)),
-		('Populating logdays and stores', lambda: populate_auxiliary(cur, conn)),
-		('Populating needs',           lambda: populate_needs(conn))
+		('Loading rc_products CSV',    lambda: copy_csv(cur, 'rc_products', rc_csv)),
+		('Loading branch_products CSV',lambda: copy_csv(cur, 'branch_products', bp_csv)),
+		('Populating products table',  lambda: populate_products(cur, prod_csv)),
+		('Populating logdays and stores', lambda: populate_auxiliary(cur, seed)),
+		# needs workers use their own sessions, so the load is committed first
+		('Populating needs',           lambda: conn.commit() or populate_needs(db, workers, seed))
 	]
 
 	overall = tqdm(total=len(steps), desc='Overall progress')